@@ -14,84 +14,378 @@ Example:
 """
 
 import email
+import email.parser
 import email.utils
+import itertools
+import mmap
+import os
 import random
+import re
+import smtplib
 import socket
+import stat
 import string
 import subprocess
 import sys
+import tempfile
 import time
-import uuid
+
+SENDMAIL = "/usr/sbin/sendmail"
+
+# Local MTA used to submit all copies over a single connection. If nothing
+# listens there (or SMTP_HOST is None) one `sendmail -bs` session is used.
+SMTP_HOST = "localhost"
+SMTP_PORT = 25
+SMTP_TIMEOUT = 30
+
+# Inputs larger than this (bytes) are memory-mapped when stdin is a file
+MMAP_THRESHOLD = 1 << 20
+
+# Resolved once: getfqdn() may do a blocking reverse DNS lookup
+_FQDN = socket.getfqdn()
+
+# Message-ID uniqueness: random per process, then a local counter
+_NONCE = os.urandom(6).hex()
+_COUNTER = itertools.count()
+
+_TAG_ALPHABET = (string.ascii_letters + string.digits).encode("ascii")
 
 
 def generate_message_id():
     """Generate a unique RFC-compliant Message-ID."""
-    ts = int(time.time())
-    uid = uuid.uuid4().hex[:12]
-    fqdn = socket.getfqdn()
-    return f"<{ts}.{uid}@{fqdn}>"
+    return f"<{int(time.time())}.{_NONCE}{next(_COUNTER):06x}@{_FQDN}>"
 
 
 def random_tag(length=4):
     """Return a random alphanumeric tag of the given length."""
-    chars = string.ascii_letters + string.digits
-    return "".join(random.choices(chars, k=length))
+    # Each PRNG draw supplies 6 bits per character; values past the end of
+    # the 62-character alphabet are discarded rather than wrapped, which
+    # would make some characters twice as likely as the rest.
+    chars = []
+    while len(chars) < length:
+        bits = random.getrandbits(6 * length)
+        for _ in range(length):
+            index = bits & 0x3F
+            bits >>= 6
+            if index < len(_TAG_ALPHABET):
+                chars.append(_TAG_ALPHABET[index])
+    return bytes(chars[:length]).decode("ascii")
 
 
-def make_copy(original_bytes, destination):
+_BLANK_LINE = re.compile(rb"(\r?\n)\r?\n")
+
+# Headers rewritten (or dropped) on every copy; all others pass through as-is
+REPLACED_HEADERS = frozenset(
+    [
+        b"to",
+        b"message-id",
+        b"subject",
+        b"x-kayako-dup",
+        b"in-reply-to",
+        b"references",
+    ]
+)
+
+
+def split_message(raw):
     """
-    Produce a modified copy of the email for a single destination.
+    Split raw email bytes at the first blank line.
+
+    raw may be bytes or any buffer supporting the same (e.g. an mmap).
+    Returns (header_blob, body, linesep), where body is a zero-copy
+    memoryview of raw and linesep is the line ending used by the message
+    (b"\r\n" or b"\n"). The separating blank line belongs to neither part.
+    """
+    for linesep in (b"\r\n", b"\n"):
+        if raw[: len(linesep)] == linesep:
+            # Blank first line: the message has no headers at all
+            return b"", memoryview(raw)[len(linesep):], linesep
+    match = _BLANK_LINE.search(raw)
+    if match is None:
+        # Header-only message
+        linesep = b"\r\n" if raw[-2:] == b"\r\n" else b"\n"
+        return bytes(raw), memoryview(b""), linesep
+    return raw[: match.start()], memoryview(raw)[match.end():], match.group(1)
+
+
+def rewrite_headers(header_blob, destination, message_id, tag, linesep=b"\n"):
+    """
+    Rewrite the raw header block of a message for a single destination.
+
+    Works on the header bytes directly: untouched fields (including their
+    folding and any encoded words) are copied through verbatim. Returns the
+    new header block, ending with the blank line that separates it from the
+    body, so the original body can be sent after it unchanged.
 
     Changes applied:
     - To: replaced with the destination address (Kayako discards mismatches)
-    - New unique Message-ID
-    - Subject appended with a random 4-char tag
+    - Message-ID replaced with message_id
+    - Subject appended with " [tag]"
     - X-Kayako-Dup: 1 sentinel added
     - In-Reply-To and References stripped
     """
-    msg = email.message_from_bytes(original_bytes)
+    lines = header_blob.splitlines(keepends=True)
+    if lines and lines[0].startswith(b"From "):
+        # Drop the mbox envelope line; it is not a header
+        del lines[0]
 
-    # Replace To: with the destination so Kayako accepts the message
-    del msg["To"]
-    msg["To"] = destination
+    # Group physical lines into fields (continuation lines start with SP/HT)
+    fields = []
+    for line in lines:
+        if line[:1] in (b" ", b"\t") and fields:
+            fields[-1].append(line)
+        else:
+            fields.append([line])
 
-    # Replace Message-ID
-    del msg["Message-ID"]
-    msg["Message-ID"] = generate_message_id()
+    kept = []
+    subject = None
+    for field in fields:
+        name = field[0].split(b":", 1)[0].strip().lower()
+        if name not in REPLACED_HEADERS:
+            kept.extend(field)
+        elif name == b"subject" and subject is None:
+            subject = b"".join(field).rstrip(b"\r\n")
+    if kept and not kept[-1].endswith((b"\r", b"\n")):
+        kept[-1] += linesep
 
-    # Append unique tag to Subject
-    subject = msg.get("Subject", "")
-    del msg["Subject"]
-    msg["Subject"] = f"{subject} [{random_tag()}]"
+    if subject is None:
+        subject = b"Subject:"
+    new = [
+        b"To: " + destination.encode("utf-8"),
+        b"Message-ID: " + message_id.encode("ascii"),
+        subject + b" [" + tag.encode("ascii") + b"]",
+        b"X-Kayako-Dup: 1",
+        b"",
+    ]
+    return b"".join(kept) + linesep.join(new) + linesep
 
-    # Add anti-loop sentinel
-    del msg["X-Kayako-Dup"]
-    msg["X-Kayako-Dup"] = "1"
 
-    # Strip threading headers so Kayako doesn't link copies together
-    del msg["In-Reply-To"]
-    del msg["References"]
+def make_copy(original_bytes, destination):
+    """
+    Produce a modified copy of the email for a single destination.
 
-    return msg
+    Convenience wrapper returning a parsed message; main() sends the header
+    block from rewrite_headers() followed by the original body instead.
+    """
+    headers, body, linesep = split_message(original_bytes)
+    headers = rewrite_headers(
+        headers, destination, generate_message_id(), random_tag(), linesep
+    )
+    return email.message_from_bytes(headers + body)
 
 
-def send_copy(msg, envelope_sender, destination):
-    """Re-inject a message via sendmail."""
-    cmd = ["/usr/sbin/sendmail", "-i", "-f", envelope_sender, destination]
-    proc = subprocess.Popen(
-        cmd,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    stdout, stderr = proc.communicate(msg.as_bytes())
-    if proc.returncode != 0:
-        raise RuntimeError(
-            f"sendmail failed for {destination} (exit {proc.returncode}): "
-            f"{stderr.decode(errors='replace').strip()}"
+class SendmailSMTP(smtplib.SMTP):
+    """
+    SMTP session with a `sendmail -bs` child instead of a network MTA.
+
+    The child speaks SMTP on its stdin/stdout, which are connected to one
+    end of a socket pair; smtplib talks to the other end. All copies are
+    submitted through this one process.
+    """
+
+    def __init__(self, timeout=SMTP_TIMEOUT):
+        self.proc = None
+        self.errlog = None
+        self.stderr_output = ""
+        try:
+            super().__init__("localhost", local_hostname=_FQDN, timeout=timeout)
+        except smtplib.SMTPException as exc:
+            # The session failed to open; sendmail's stderr says why
+            if self.stderr_output:
+                raise smtplib.SMTPException(
+                    f"{SENDMAIL} -bs failed: {exc}: {self.stderr_output}"
+                ) from exc
+            raise
+
+    def _get_socket(self, host, port, timeout):
+        parent, child = socket.socketpair()
+        # A file rather than a pipe, so a chatty child can never block
+        self.errlog = tempfile.TemporaryFile()
+        try:
+            self.proc = subprocess.Popen(
+                [SENDMAIL, "-bs"],
+                stdin=child,
+                stdout=child,
+                stderr=self.errlog,
+            )
+        except OSError:
+            parent.close()
+            self.errlog.close()
+            raise
+        finally:
+            child.close()
+        parent.settimeout(timeout)
+        return parent
+
+    def close(self):
+        super().close()
+        if self.proc is not None:
+            # sendmail exits once it sees end-of-file on its input
+            self.proc.wait()
+            self.proc = None
+            self.errlog.seek(0)
+            self.stderr_output = (
+                self.errlog.read().decode(errors="replace").strip()
+            )
+            self.errlog.close()
+
+
+def open_smtp():
+    """
+    Open the SMTP session used to submit every copy.
+
+    Connects to the local MTA if one is listening on SMTP_HOST, otherwise
+    starts a single `sendmail -bs` session.
+    """
+    if SMTP_HOST:
+        try:
+            return smtplib.SMTP(
+                SMTP_HOST, SMTP_PORT, local_hostname=_FQDN, timeout=SMTP_TIMEOUT
+            )
+        except (OSError, smtplib.SMTPException):
+            pass
+    return SendmailSMTP()
+
+
+# Bare CR or LF, or a line starting with "."
+_NEEDS_ENCODING = re.compile(rb"\r(?!\n)|(?<!\r)\n|^\.|\n\.")
+
+
+def smtp_data(data):
+    """Encode bytes for SMTP DATA: CRLF line endings, leading dots doubled."""
+    data = re.sub(rb"\r\n|\r|\n", b"\r\n", data)
+    return re.sub(rb"(?m)^\.", b"..", data)
+
+
+def smtp_body(body):
+    """
+    Encode a message body for DATA, including the terminating "." line.
+
+    Done once per run: the returned buffers are shared by every copy. A body
+    that already has CRLF line endings and no leading dots is passed through
+    as-is rather than copied.
+    """
+    if _NEEDS_ENCODING.search(body):
+        body = smtp_data(body)
+    if len(body) and body[-2:] != b"\r\n":
+        return [body, b"\r\n.\r\n"]
+    return [body, b".\r\n"]
+
+
+class DeliveryUnconfirmed(smtplib.SMTPException):
+    """Session lost after a whole copy was sent; it must not be retried."""
+
+
+def _rset(smtp):
+    try:
+        smtp.rset()
+    except (smtplib.SMTPException, OSError):
+        pass
+
+
+def _quit(smtp):
+    try:
+        smtp.quit()
+    except (smtplib.SMTPException, OSError):
+        smtp.close()
+
+
+def _check_closing(smtp, code, resp):
+    """Treat a 421 reply as a lost session: the MTA is closing it."""
+    if code == 421:
+        smtp.close()
+        raise smtplib.SMTPServerDisconnected(
+            f"{code} {resp.decode(errors='replace')}"
         )
 
 
+def _sendmsg_all(sock, buffers):
+    """Write all buffers to sock, using as few vectored sends as possible."""
+    buffers = [memoryview(b) for b in buffers if len(b)]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+
+def send_copy(headers, body_data, envelope_sender, destination, smtp):
+    """
+    Submit one copy over an SMTP session.
+
+    body_data is the list of buffers returned by smtp_body(). The copy's
+    header block and the shared body go out together in a single vectored
+    send, so the body is never concatenated with, or re-encoded for, each
+    copy.
+    """
+    smtp.ehlo_or_helo_if_needed()
+    sender, options = envelope_sender, []
+    if not (envelope_sender + destination).isascii():
+        if smtp.has_extn("smtputf8"):
+            options = ["SMTPUTF8"]
+        elif not envelope_sender.isascii():
+            # Unrepresentable without SMTPUTF8; fall back to the null sender
+            sender = ""
+    try:
+        code, resp = smtp.mail(sender, options)
+        _check_closing(smtp, code, resp)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, resp, sender)
+        code, resp = smtp.rcpt(destination)
+        _check_closing(smtp, code, resp)
+        if code not in (250, 251):
+            raise smtplib.SMTPRecipientsRefused({destination: (code, resp)})
+        code, resp = smtp.docmd("DATA")
+        _check_closing(smtp, code, resp)
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        try:
+            _sendmsg_all(smtp.sock, [smtp_data(headers), *body_data])
+        except OSError as exc:
+            # The terminating "." never arrived, so nothing was queued
+            smtp.close()
+            raise smtplib.SMTPServerDisconnected(
+                f"connection lost while sending: {exc}"
+            ) from exc
+        try:
+            code, resp = smtp.getreply()
+        except smtplib.SMTPServerDisconnected as exc:
+            # The MTA may have queued the copy already; retrying could
+            # create a duplicate ticket
+            raise DeliveryUnconfirmed(
+                f"connection lost after the message was sent, it may or may "
+                f"not have been queued: {exc}"
+            ) from exc
+        _check_closing(smtp, code, resp)
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+    except BaseException:
+        # Never leave the shared session mid-transaction for the next copy
+        _rset(smtp)
+        raise
+
+
+def read_input(stream):
+    """
+    Read the inbound message from a binary stream.
+
+    A large regular file (e.g. a queue file redirected to stdin) is
+    memory-mapped read-only instead of being copied onto the heap.
+    """
+    try:
+        fd = stream.fileno()
+        st = os.fstat(fd)
+        at_start = os.lseek(fd, 0, os.SEEK_CUR) == 0
+    except (OSError, ValueError):
+        return stream.read()
+    if stat.S_ISREG(st.st_mode) and st.st_size > MMAP_THRESHOLD and at_start:
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    return stream.read()
+
+
 def main():
     if len(sys.argv) < 2:
         print(
@@ -105,26 +399,52 @@ def main():
         print("Error: no destination addresses provided.", file=sys.stderr)
         sys.exit(1)
 
-    raw = sys.stdin.buffer.read()
+    raw = read_input(sys.stdin.buffer)
     if not raw:
         print("Error: no email data on stdin.", file=sys.stderr)
         sys.exit(1)
 
-    # Parse once just to extract the envelope sender
-    original = email.message_from_bytes(raw)
+    # Only the headers are parsed; every copy reuses the original body bytes
+    header_blob, body, linesep = split_message(raw)
+    # Decoded first: raw 8-bit headers would otherwise come back as Header
+    # objects, which parseaddr() cannot handle
+    original = email.parser.HeaderParser().parsestr(
+        header_blob.decode("utf-8", "replace")
+    )
     envelope_sender = email.utils.parseaddr(original.get("From", ""))[1]
 
-    errors = []
-    for dest in destinations:
-        try:
-            copy = make_copy(raw, dest)
-            send_copy(copy, envelope_sender, dest)
-        except Exception as exc:
-            errors.append(f"{dest}: {exc}")
-
-    if errors:
-        for err in errors:
-            print(f"Error: {err}", file=sys.stderr)
+    try:
+        smtp = open_smtp()
+    except (OSError, smtplib.SMTPException) as exc:
+        print(f"Error: cannot start mail submission: {exc}", file=sys.stderr)
+        sys.exit(1)
+
+    # One session carries every copy; the body is encoded for it only once
+    body_data = smtp_body(body)
+    had_error = False
+    try:
+        for dest in destinations:
+            try:
+                headers = rewrite_headers(
+                    header_blob, dest, generate_message_id(), random_tag(), linesep
+                )
+                try:
+                    send_copy(headers, body_data, envelope_sender, dest, smtp)
+                except smtplib.SMTPServerDisconnected:
+                    # The session was lost before the copy was sent in full
+                    # (a 421 reply, an MTA restart...); reconnect and retry
+                    # once. DeliveryUnconfirmed is deliberately not retried.
+                    smtp.close()
+                    smtp = open_smtp()
+                    send_copy(headers, body_data, envelope_sender, dest, smtp)
+            except Exception as exc:
+                # Report immediately rather than holding every failure
+                had_error = True
+                print(f"Error: {dest}: {exc}", file=sys.stderr, flush=True)
+    finally:
+        _quit(smtp)
+
+    if had_error:
         sys.exit(1)
 
     sys.exit(0)
@@ -1,12 +1,23 @@
 """
 Unit tests for kayako_duplicator.py
 
-Tests use the module's make_copy() function directly (no sendmail calls).
+Most tests use the module's make_copy() function directly; delivery tests
+run against a stand-in sendmail script and never contact a real MTA.
 """
 
+import collections
+import contextlib
 import email
+import io
+import mmap
 import os
+import smtplib
+import socket
+import stat
+import subprocess
 import sys
+import tempfile
+import threading
 import unittest
 
 # Allow importing the script as a module from the project root
@@ -47,6 +58,9 @@ class TestMessageID(unittest.TestCase):
         self.assertTrue(mid.startswith("<"), f"Message-ID should start with <: {mid}")
         self.assertTrue(mid.endswith(">"), f"Message-ID should end with >: {mid}")
 
+    def test_message_id_uses_cached_fqdn(self):
+        self.assertTrue(kd.generate_message_id().endswith(f"@{kd._FQDN}>"))
+
     def test_five_copies_all_unique_ids(self):
         raw = load_fixture("simple.eml")
         addrs = [f"q{i}@kayako.com" for i in range(5)]
@@ -193,6 +207,310 @@ class TestMultipart(unittest.TestCase):
         self.assertEqual(len(ids), len(set(ids)))
 
 
+# Minimal stand-in for `sendmail -bs`: speaks SMTP on stdin/stdout, stores
+# each accepted message as <out>.<recipient> and logs one line per run.
+FAKE_SENDMAIL = """\
+import os
+import sys
+
+out, reject, drop, hangup = {out!r}, {reject!r}, {drop!r}, {hangup!r}
+smtputf8 = {smtputf8!r}
+with open(out + ".runs", "a") as f:
+    f.write(" ".join(sys.argv[1:]) + "\\n")
+rfile, wfile = sys.stdin.buffer, sys.stdout.buffer
+
+
+def reply(text):
+    wfile.write(text.encode() + b"\\r\\n")
+    wfile.flush()
+
+
+reply("220 fake ESMTP")
+rcpt = None
+in_mail = False
+for line in iter(rfile.readline, b""):
+    cmd = line.decode().strip()
+    verb = cmd.split(" ", 1)[0].upper()
+    if verb == "EHLO" and smtputf8:
+        reply("250-fake")
+        reply("250 SMTPUTF8")
+    elif verb == "MAIL":
+        with open(out + ".mail", "a") as f:
+            f.write(cmd + "\\n")
+        reply("503 nested MAIL" if in_mail else "250 ok")
+        in_mail = True
+    elif verb == "RSET":
+        in_mail = False
+        reply("250 ok")
+    elif verb == "RCPT":
+        rcpt = cmd.split(":", 1)[1].strip("<> ")
+        if rcpt in drop and not os.path.exists(out + ".dropped"):
+            # Only the first session drops, so a retry can succeed
+            open(out + ".dropped", "w").close()
+            reply("421 closing connection")
+            break
+        reply("550 rejected" if rcpt in reject else "250 ok")
+    elif verb == "DATA":
+        reply("354 go ahead")
+        data = []
+        for line in iter(rfile.readline, b".\\r\\n"):
+            data.append(line[1:] if line.startswith(b".") else line)
+        with open(out + "." + rcpt, "wb") as f:
+            f.write(b"".join(data))
+        with open(out + ".delivered", "a") as f:
+            f.write(rcpt + "\\n")
+        if rcpt in hangup:
+            # Queued, but the acknowledgement is lost
+            break
+        in_mail = False
+        reply("250 queued")
+    elif verb == "QUIT":
+        reply("221 bye")
+        break
+    else:
+        reply("250 ok")
+"""
+
+
+class FakeSendmailMixin:
+    """Point kd.SENDMAIL at a throwaway `sendmail -bs` stand-in."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.out = os.path.join(self.tmp.name, "out")
+        self.addCleanup(setattr, kd, "SENDMAIL", kd.SENDMAIL)
+        self.addCleanup(setattr, kd, "SMTP_HOST", kd.SMTP_HOST)
+        # Never talk to a real MTA from the tests
+        kd.SMTP_HOST = None
+
+    def fake_sendmail(self, reject=(), drop=(), hangup=(), smtputf8=False):
+        path = os.path.join(self.tmp.name, "sendmail")
+        with open(path, "w") as f:
+            f.write(f"#!{sys.executable}\n")
+            f.write(FAKE_SENDMAIL.format(
+                out=self.out,
+                reject=list(reject),
+                drop=list(drop),
+                hangup=list(hangup),
+                smtputf8=smtputf8,
+            ))
+        os.chmod(path, stat.S_IRWXU)
+        kd.SENDMAIL = path
+
+    def runs(self):
+        with open(self.out + ".runs") as f:
+            return f.read().splitlines()
+
+
+class TestSendCopy(FakeSendmailMixin, unittest.TestCase):
+    def send(self, headers, body, destination="a@x.com"):
+        with kd.open_smtp() as smtp:
+            self.assertIsInstance(smtp, kd.SendmailSMTP)
+            kd.send_copy(headers, kd.smtp_body(body), "s@x.com", destination, smtp)
+
+    def received(self, destination="a@x.com"):
+        with open(f"{self.out}.{destination}", "rb") as f:
+            return f.read()
+
+    def test_sendmail_bs_session(self):
+        self.fake_sendmail()
+        self.send(b"To: a@x.com\n\n", b"one\ntwo\r\n")
+        self.assertEqual(self.runs(), ["-bs"])
+        self.assertEqual(self.received(), b"To: a@x.com\r\n\r\none\r\ntwo\r\n")
+
+    def test_leading_dots_and_missing_final_newline(self):
+        self.fake_sendmail()
+        self.send(b"To: a@x.com\n\n", b".dot\n..two\nlast")
+        self.assertEqual(
+            self.received(), b"To: a@x.com\r\n\r\n.dot\r\n..two\r\nlast\r\n"
+        )
+
+    def test_empty_body(self):
+        self.fake_sendmail()
+        self.send(b"To: a@x.com\n\n", b"")
+        self.assertEqual(self.received(), b"To: a@x.com\r\n\r\n")
+
+    def test_sendmail_bs_rejection_raises(self):
+        self.fake_sendmail(reject=["a@x.com"])
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            self.send(b"To: a@x.com\n\n", b"x\n")
+
+    def test_smtp_body(self):
+        def encode(body):
+            return b"".join(kd.smtp_body(body))
+
+        self.assertEqual(encode(b"a\n.b\n"), b"a\r\n..b\r\n.\r\n")
+        self.assertEqual(encode(b".a\r\n"), b"..a\r\n.\r\n")
+        self.assertEqual(encode(b"a"), b"a\r\n.\r\n")
+        self.assertEqual(encode(b""), b".\r\n")
+
+    def test_smtp_body_crlf_not_copied(self):
+        body = memoryview(b"one\r\ntwo\r\n")
+        self.assertIs(kd.smtp_body(body)[0], body)
+
+
+class TestMain(FakeSendmailMixin, unittest.TestCase):
+    def run_main(self, raw, addresses):
+        argv, stdin = sys.argv, sys.stdin
+        sys.argv = ["kayako_duplicator.py", addresses]
+        if isinstance(raw, bytes):
+            raw = io.BytesIO(raw)
+        sys.stdin = wrapper = io.TextIOWrapper(raw)
+        try:
+            with self.assertRaises(SystemExit) as cm, \
+                    contextlib.redirect_stderr(io.StringIO()) as err:
+                kd.main()
+        finally:
+            sys.argv, sys.stdin = argv, stdin
+            wrapper.detach()
+        return cm.exception.code, err.getvalue()
+
+    def test_one_copy_per_destination_single_sendmail(self):
+        self.fake_sendmail()
+        raw = load_fixture("multipart.eml")
+        addrs = [f"q{i}@kayako.com" for i in range(5)]
+        code, _ = self.run_main(raw, ",".join(addrs))
+        self.assertEqual(code, 0)
+        self.assertEqual(self.runs(), ["-bs"])
+        body = raw.split(b"\n\n", 1)[1].replace(b"\n", b"\r\n")
+        for addr in addrs:
+            with open(f"{self.out}.{addr}", "rb") as f:
+                data = f.read()
+            self.assertEqual(email.message_from_bytes(data)["To"], addr)
+            self.assertEqual(data.split(b"\r\n\r\n", 1)[1], body)
+
+    def test_local_mta_preferred(self):
+        # Serve SMTP on a local port by running the stand-in per connection
+        self.fake_sendmail()
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+
+        def serve():
+            conn, _ = server.accept()
+            with conn:
+                subprocess.run([kd.SENDMAIL, "tcp"], stdin=conn, stdout=conn)
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        self.addCleanup(setattr, kd, "SMTP_PORT", kd.SMTP_PORT)
+        kd.SMTP_HOST, kd.SMTP_PORT = server.getsockname()
+        code, _ = self.run_main(load_fixture("simple.eml"), "a@x.com,b@x.com")
+        thread.join()
+        self.assertEqual(code, 0)
+        self.assertEqual(self.runs(), ["tcp"])
+        for addr in ["a@x.com", "b@x.com"]:
+            self.assertTrue(os.path.exists(f"{self.out}.{addr}"))
+
+    def test_large_file_input_memory_mapped(self):
+        self.fake_sendmail()
+        self.addCleanup(setattr, kd, "MMAP_THRESHOLD", kd.MMAP_THRESHOLD)
+        kd.MMAP_THRESHOLD = 0
+        path = os.path.join(self.tmp.name, "in.eml")
+        raw = load_fixture("multipart.eml").replace(b"\n", b"\r\n")
+        with open(path, "wb") as f:
+            f.write(raw)
+        with open(path, "rb") as f:
+            self.assertIsInstance(kd.read_input(f), mmap.mmap)
+        with open(path, "rb") as f:
+            code, _ = self.run_main(f, "a@x.com")
+        self.assertEqual(code, 0)
+        with open(self.out + ".a@x.com", "rb") as f:
+            received = f.read()
+        self.assertEqual(
+            received.split(b"\r\n\r\n", 1)[1], raw.split(b"\r\n\r\n", 1)[1]
+        )
+
+    def test_failures_reported(self):
+        self.fake_sendmail(reject=["a@x.com", "c@x.com"])
+        raw = load_fixture("simple.eml")
+        code, err = self.run_main(raw, "a@x.com,b@x.com,c@x.com")
+        self.assertEqual(code, 1)
+        lines = err.splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith("Error: a@x.com: "))
+        self.assertTrue(lines[1].startswith("Error: c@x.com: "))
+        self.assertTrue(os.path.exists(self.out + ".b@x.com"))
+
+    def test_failed_destination_does_not_affect_next(self):
+        # smtplib cannot encode the non-ASCII address, mid-transaction
+        self.fake_sendmail(reject=["bad@x.com"])
+        raw = load_fixture("simple.eml")
+        code, err = self.run_main(raw, "büro@x.com,ok@x.com,bad@x.com,ok2@x.com")
+        self.assertEqual(code, 1)
+        lines = err.splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith("Error: büro@x.com: "))
+        self.assertTrue(lines[1].startswith("Error: bad@x.com: "))
+        self.assertTrue(os.path.exists(self.out + ".ok@x.com"))
+        self.assertTrue(os.path.exists(self.out + ".ok2@x.com"))
+
+    def test_reconnects_after_session_lost(self):
+        # A 421 on b@x.com closes the first session; b@x.com is retried
+        self.fake_sendmail(drop=["b@x.com"])
+        raw = load_fixture("simple.eml")
+        code, err = self.run_main(raw, "a@x.com,b@x.com,c@x.com,d@x.com")
+        self.assertEqual(code, 0)
+        self.assertEqual(err, "")
+        self.assertEqual(self.runs(), ["-bs", "-bs"])
+        for addr in ["a@x.com", "b@x.com", "c@x.com", "d@x.com"]:
+            self.assertTrue(os.path.exists(f"{self.out}.{addr}"))
+
+    def test_no_retry_once_message_sent(self):
+        # The session drops after b@x.com's data was sent in full
+        self.fake_sendmail(hangup=["b@x.com"])
+        raw = load_fixture("simple.eml")
+        code, err = self.run_main(raw, "a@x.com,b@x.com,c@x.com")
+        self.assertEqual(code, 1)
+        lines = err.splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith("Error: b@x.com: "))
+        self.assertIn("may or may not have been queued", lines[0])
+        self.assertEqual(self.runs(), ["-bs", "-bs"])
+        with open(self.out + ".delivered") as f:
+            self.assertEqual(f.read().split(), ["a@x.com", "b@x.com", "c@x.com"])
+
+    def run_non_ascii_sender(self, smtputf8):
+        self.fake_sendmail(smtputf8=smtputf8)
+        raw = load_fixture("simple.eml").replace(
+            b"Alice Sender <alice@example.com>",
+            "Jörg <jörg@exämple.com>".encode("utf-8"),
+        )
+        code, err = self.run_main(raw, "a@x.com,b@x.com")
+        self.assertEqual((code, err), (0, ""))
+        for addr in ["a@x.com", "b@x.com"]:
+            self.assertTrue(os.path.exists(f"{self.out}.{addr}"))
+        with open(self.out + ".mail", encoding="utf-8") as f:
+            return f.read().splitlines()
+
+    def test_non_ascii_sender_with_smtputf8(self):
+        mail = self.run_non_ascii_sender(smtputf8=True)
+        self.assertEqual(mail, ["mail FROM:<jörg@exämple.com> SMTPUTF8"] * 2)
+
+    def test_non_ascii_sender_without_smtputf8(self):
+        mail = self.run_non_ascii_sender(smtputf8=False)
+        self.assertEqual(mail, ["mail FROM:<>"] * 2)
+
+    def test_sendmail_startup_error_shown(self):
+        path = os.path.join(self.tmp.name, "sendmail")
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\necho 'fatal: bad config' >&2\nexit 75\n")
+        os.chmod(path, stat.S_IRWXU)
+        kd.SENDMAIL = path
+        code, err = self.run_main(load_fixture("simple.eml"), "a@x.com")
+        self.assertEqual(code, 1)
+        self.assertIn("Error: cannot start mail submission", err)
+        self.assertIn("fatal: bad config", err)
+
+    def test_sendmail_missing(self):
+        kd.SENDMAIL = os.path.join(self.tmp.name, "missing")
+        code, err = self.run_main(load_fixture("simple.eml"), "a@x.com")
+        self.assertEqual(code, 1)
+        self.assertIn("Error: cannot start mail submission", err)
+
+
 class TestEdgeCases(unittest.TestCase):
     def test_single_address(self):
         raw = load_fixture("simple.eml")
@@ -217,6 +535,80 @@ class TestEdgeCases(unittest.TestCase):
         self.assertEqual(len(set(ids)), 5)
         self.assertEqual(len(set(subjects)), 5)
 
+    def test_split_message(self):
+        raw = load_fixture("multipart.eml")
+        headers, body, linesep = kd.split_message(raw)
+        self.assertEqual(linesep, b"\n")
+        self.assertEqual(headers + b"\n\n" + body, raw)
+        self.assertTrue(bytes(body).startswith(b"--==boundary_12345=="))
+
+    def test_split_message_mmap(self):
+        raw = load_fixture("simple.eml")
+        with tempfile.TemporaryFile() as f:
+            f.write(raw)
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                headers, body, linesep = kd.split_message(mapped)
+                self.assertEqual(headers + b"\n\n" + body, raw)
+                body.release()
+
+    def test_split_message_no_headers(self):
+        headers, body, linesep = kd.split_message(b"\nbody line\n\nmore")
+        self.assertEqual(headers, b"")
+        self.assertEqual(bytes(body), b"body line\n\nmore")
+        self.assertEqual(linesep, b"\n")
+        headers, body, linesep = kd.split_message(b"\r\nbody\r\n\r\nmore")
+        self.assertEqual(headers, b"")
+        self.assertEqual(bytes(body), b"body\r\n\r\nmore")
+        self.assertEqual(linesep, b"\r\n")
+
+    def test_copy_of_message_without_headers(self):
+        copy = kd.make_copy(b"\nbody line\n\nmore", "a@x.com")
+        self.assertEqual(copy["To"], "a@x.com")
+        self.assertEqual(copy["X-Kayako-Dup"], "1")
+        self.assertEqual(copy.get_payload(), "body line\n\nmore")
+
+    def test_split_message_crlf(self):
+        raw = load_fixture("simple.eml").replace(b"\n", b"\r\n")
+        headers, body, linesep = kd.split_message(raw)
+        self.assertEqual(linesep, b"\r\n")
+        self.assertEqual(headers + b"\r\n\r\n" + body, raw)
+
+    def test_rewrite_headers(self):
+        raw = load_fixture("multipart.eml")
+        headers, body, linesep = kd.split_message(raw)
+        new = kd.rewrite_headers(headers, "a@x.com", "<id@host>", "AbC1", linesep)
+        self.assertEqual(
+            new,
+            b"From: Bob Sender <bob@example.com>\n"
+            b"Date: Thu, 27 Feb 2026 11:00:00 +0000\n"
+            b"MIME-Version: 1.0\n"
+            b'Content-Type: multipart/mixed; boundary="==boundary_12345=="\n'
+            b"To: a@x.com\n"
+            b"Message-ID: <id@host>\n"
+            b"Subject: Issue with invoice [AbC1]\n"
+            b"X-Kayako-Dup: 1\n"
+            b"\n",
+        )
+
+    def test_rewrite_headers_folded_fields(self):
+        headers = (
+            b"From mbox-envelope Thu Feb 27 10:00:00 2026\r\n"
+            b"Subject: =?utf-8?q?caf=C3=A9?=\r\n =?utf-8?q?_order?=\r\n"
+            b"References: <a@x>\r\n\t<b@x>\r\n"
+            b"X-Other: keep\r\n  me"
+        )
+        new = kd.rewrite_headers(headers, "a@x.com", "<id@host>", "AbC1", b"\r\n")
+        self.assertEqual(
+            new,
+            b"X-Other: keep\r\n  me\r\n"
+            b"To: a@x.com\r\n"
+            b"Message-ID: <id@host>\r\n"
+            b"Subject: =?utf-8?q?caf=C3=A9?=\r\n =?utf-8?q?_order?= [AbC1]\r\n"
+            b"X-Kayako-Dup: 1\r\n"
+            b"\r\n",
+        )
+
     def test_generate_message_id_is_unique(self):
         ids = {kd.generate_message_id() for _ in range(100)}
         self.assertEqual(len(ids), 100, "generate_message_id must be unique per call")
@@ -226,6 +618,15 @@ class TestEdgeCases(unittest.TestCase):
             tag = kd.random_tag()
             self.assertEqual(len(tag), 4)
 
+    def test_random_tag_custom_length(self):
+        self.assertRegex(kd.random_tag(12), r"^[A-Za-z0-9]{12}$")
+
+    def test_random_tag_distribution_not_skewed(self):
+        counts = collections.Counter("".join(kd.random_tag() for _ in range(20000)))
+        self.assertEqual(len(counts), 62)
+        # ~1290 expected per character; wrapping bias would double some
+        self.assertLess(max(counts.values()) / min(counts.values()), 1.3)
+
     def test_random_tag_alphanumeric(self):
         import re
         for _ in range(20):